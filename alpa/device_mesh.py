@@ -1161,6 +1161,9 @@ class DistributedPhysicalDeviceMesh(PhysicalDeviceMesh):
             slow_path = False
 
             if is_batch_var:
+                if isinstance(arg, ReplicatedDistributedArray):
+                    # A batch var used by multiple meshes
+                    arg = arg.get_replica_on_mesh(self)
                 if (isinstance(arg, DistributedArray) and
                         arg.skip_shard_args_check is True):
                     assert num_micro_batches == 1
@@ -14,6 +14,12 @@ python benchmark_text_gen.py --model alpa/opt-2.7b --debug
 python benchmark_text_gen.py --model alpa/opt-2.7b --forward
     --decoder_length 1024 --nb 1 --batch-size 256 --debug
 
+5. benchmark alpa parallelized OPT generation with an int8 attention cache:
+python benchmark_text_gen.py --model alpa/opt-2.7b --cache-dtype int8 --debug
+
+6. benchmark alpa parallelized OPT generation with int8 weights:
+python benchmark_text_gen.py --model alpa/opt-2.7b --quant int8 --debug
+
 Notes:
 1. fp32 does not work now because of embedding
 """
@@ -56,8 +62,30 @@ if __name__ == "__main__":
     parser.add_argument("--num-beams", type=int, default=1)
     parser.add_argument("--debug", action="store_true")
     parser.add_argument("--dtype", type=str, default="fp16")
+    parser.add_argument("--cache-dtype",
+                        type=str,
+                        default=None,
+                        choices=["int8"],
+                        help="Quantize the attention cache of jax/alpa models.")
+    parser.add_argument(
+        "--quant",
+        type=str,
+        default=None,
+        choices=["int8"],
+        help="Quantize the weights of the linear layers of jax/alpa models.")
+    parser.add_argument(
+        "--compilation-cache-dir",
+        type=str,
+        default=None,
+        help="Persist jax.jit compilations across runs in this directory.")
     args = parser.parse_args()
 
+    if args.compilation_cache_dir:
+        # Note: this only covers executables compiled by jax.jit (i.e.,
+        # the jax/opt models). Alpa compiles its executables separately.
+        from jax.experimental.compilation_cache import compilation_cache
+        compilation_cache.initialize_cache(args.compilation_cache_dir)
+
     # Some global params
     warmup_iters = 5
     n_iters = 10
@@ -65,9 +93,12 @@ if __name__ == "__main__":
     global_config.shard_parallel_sync_for_timer = True
 
     # Note(Hao): we need to use "opt-30b" and disable "add_bos_token".
+    # The fast tokenizer ignores "add_bos_token", so we call it with
+    # "add_special_tokens=False" instead.
     tokenizer = AutoTokenizer.from_pretrained("facebook/opt-30b",
-                                              use_fast=False)
-    tokenizer.add_bos_token = False
+                                              use_fast=True)
+    # Left padding keeps the last token of all prompts aligned for batching.
+    tokenizer.padding_side = "left"
 
     # Do some param check
     num_micro_batches = args.nb
@@ -76,11 +107,12 @@ if __name__ == "__main__":
     num_beams = args.num_beams
     autoregressive = not args.forward
     dtype = jnp.float16 if args.dtype == "fp16" else jnp.float32
+    cache_dtype = jnp.int8 if args.cache_dtype == "int8" else None
+    weight_dtype = jnp.int8 if args.quant == "int8" else None
 
     if autoregressive:
         assert num_micro_batches == 1, "we only support num_micro_batches=1 for autoregressive!"
         assert decoder_length_per_step == 1, "Decoding one token at a time!"
-        assert batch_size == 1, "batch_size > 1 in autoregressive is not tested!"
 
     decode_speeds = []
     tflopss = []
@@ -98,6 +130,7 @@ if __name__ == "__main__":
             args.path,
             autoregressive,
             dtype=dtype,
+            weight_dtype=weight_dtype,
             dummy=args.dummy,
             batch_size=batch_size,
             decoding_length_per_step=decoder_length_per_step,
@@ -173,14 +206,20 @@ if __name__ == "__main__":
                           args.path,
                           autoregressive,
                           dtype=dtype,
+                          cache_dtype=cache_dtype,
+                          weight_dtype=weight_dtype,
                           dummy=args.dummy,
+                          batch_size=batch_size,
                           num_beams=num_beams)
         load_time = time.time() - tic
 
         # warm up
-        input_ids = tokenizer("Paris is the capital city of",
-                              return_tensors="pt").input_ids.to(args.device)
-        output = model.generate(input_ids=input_ids,
+        inputs = tokenizer(["Paris is the capital city of"] * batch_size,
+                           return_tensors="pt",
+                           padding=True,
+                           add_special_tokens=False).to(args.device)
+        output = model.generate(input_ids=inputs.input_ids,
+                                attention_mask=inputs.attention_mask,
                                 max_length=256,
                                 do_sample=False,
                                 return_dict_in_generate=True,
@@ -199,24 +238,46 @@ if __name__ == "__main__":
         else:
             num_gpus = 1
 
+        def sync_func():
+            # Wait for all async work so that it is counted in the latency.
+            if "cuda" in args.device:
+                torch.cuda.synchronize()
+            if "alpa" in args.model:
+                model.executable.sync()
+
+        # Tokenize all batches ahead of the benchmark loop.
+        # The executable is compiled for a fixed batch size, so cycle
+        # through the test prompts to fill up each batch.
+        batches = []
+        for i in range(n_iters):
+            prompts = [
+                test_prompts[(i * batch_size + j) % len(test_prompts)]
+                for j in range(batch_size)
+            ]
+            batches.append(
+                tokenizer(prompts,
+                          return_tensors="pt",
+                          padding=True,
+                          add_special_tokens=False).to(args.device))
+
         # benchmark
-        for i in range(min(n_iters, len(test_prompts))):
-            prompt = test_prompts[i]
+        for inputs in batches:
             torch.manual_seed(8)
-            input_ids = tokenizer(prompt,
-                                  return_tensors="pt").input_ids.to(args.device)
+            input_ids = inputs.input_ids
+            sync_func()
             tic = time.time()
             output = model.generate(input_ids=input_ids,
+                                    attention_mask=inputs.attention_mask,
                                     max_length=256,
                                     do_sample=False,
                                     return_dict_in_generate=True,
                                     output_hidden_states=False,
                                     num_beams=num_beams)
-            latency = time.time() - tic
             generated_ids = output.sequences
-            generated_string = tokenizer.batch_decode(generated_ids,
-                                                      skip_special_tokens=True)
+            sync_func()
+            latency = time.time() - tic
 
+            # Everything below is outside of the timed region
             gen_len = generated_ids.shape[1]
 
             if "alpa" in args.model:
@@ -236,7 +297,9 @@ if __name__ == "__main__":
                     f"input length: {input_ids.shape[1]}, output_length: {generated_ids.shape[1]}, "
                     f"num_gpus: {num_gpus}, speed: {speed:.2f} tokens/s, tflops: {tflops:.4f} tflops/s"
                 )
-                print(generated_string)
+                print(
+                    tokenizer.batch_decode(generated_ids,
+                                           skip_special_tokens=True))
             decode_speeds.append(speed)
             tflopss.append(tflops)
             compute_tflopss.append(compute_tflops)
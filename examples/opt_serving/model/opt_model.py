@@ -72,6 +72,13 @@ class OPTConfig:
     num_pp_stages: int = None
     # parallelize
     mark_boundary: bool = True
+    # The dtype of the attention cache. None means using dtype. jnp.int8
+    # stores keys and values with a scale per token per head.
+    cache_dtype: any = None
+    # The dtype of the kernels of the linear layers in the transformer
+    # layers. None means using dtype. jnp.int8 stores kernels with a scale
+    # per output channel.
+    weight_dtype: any = None
 
 
 class OPTEmbeddings(nn.Module):
@@ -114,6 +121,65 @@ class OPTEmbeddings(nn.Module):
         return hidden_states
 
 
+def quantize_int8(x):
+    """Quantize x to int8 with an absmax scale along the last axis."""
+    scale = jnp.max(jnp.abs(x), axis=-1, keepdims=True) / 127
+    scale = jnp.maximum(scale, jnp.finfo(x.dtype).tiny)
+    return jnp.round(x / scale).astype(jnp.int8), scale
+
+
+def quantize_kernel_int8_np(kernel):
+    """Quantize a (in, out) kernel to int8 with an absmax scale per output
+    channel."""
+    kernel = kernel.astype(np.float32)
+    scale = np.max(np.abs(kernel), axis=0, keepdims=True) / 127
+    scale = np.maximum(scale, np.finfo(np.float32).tiny)
+    return np.round(kernel / scale).astype(np.int8), scale
+
+
+class QuantizedDense(nn.Module):
+    """A Dense layer with an int8 kernel and a scale per output channel."""
+    features: int
+    dtype: jnp.dtype = jnp.float16
+
+    @nn.compact
+    def __call__(self, inputs):
+        kernel = self.param("kernel", nn.initializers.zeros,
+                            (inputs.shape[-1], self.features), jnp.int8)
+        kernel_scale = self.param("kernel_scale", nn.initializers.ones,
+                                  (1, self.features), self.dtype)
+        bias = self.param("bias", nn.initializers.zeros, (self.features,),
+                          self.dtype)
+        inputs = inputs.astype(self.dtype)
+        # The scales are per output channel, so they are applied after the
+        # matmul instead of to the whole kernel.
+        outputs = lax.dot_general(inputs, kernel.astype(self.dtype),
+                                  (((inputs.ndim - 1,), (0,)), ((), ())))
+        return outputs * kernel_scale[0] + bias
+
+
+def get_dense(config, features, dtype):
+    """Get a linear layer of the transformer layers."""
+    if config.weight_dtype == jnp.int8:
+        return QuantizedDense(features, dtype=dtype)
+    return nn.Dense(features, dtype=dtype)
+
+
+def build_padding_bias(left_pad_lens, query_start, num_queries, num_keys,
+                       dtype):
+    """Build the attention bias that masks out the left padding tokens.
+
+    Each query can always attend to itself, so the rows of padding tokens
+    do not end up fully masked.
+    """
+    key_idxs = jnp.arange(num_keys)
+    query_idxs = query_start + jnp.arange(num_queries)
+    is_pad = key_idxs[None, :] < left_pad_lens[:, None]
+    is_self = query_idxs[:, None] == key_idxs[None, :]
+    mask = jnp.logical_and(is_pad[:, None, :], ~is_self[None, :, :])
+    return jnp.expand_dims(mask.astype(dtype) * -1e10, 1)
+
+
 class OPTSelfAttention(nn.Module):
     config: OPTConfig
     dtype: jnp.dtype = jnp.float16  # the dtype of the computation
@@ -125,15 +191,15 @@ class OPTSelfAttention(nn.Module):
                 f"multiple of `decoder_attention_heads`: {self.config.decoder_attention_heads}"
             )
 
-        self.qvk_combined = nn.Dense(
-            self.config.decoder_embed_dim * 3,
-            dtype=self.dtype,
-        )
+        self.qvk_combined = get_dense(self.config,
+                                      self.config.decoder_embed_dim * 3,
+                                      dtype=self.dtype)
 
     def __call__(self,
                  hidden_states,
                  output_attentions: bool = False,
-                 attention_cache=None):
+                 attention_cache=None,
+                 left_pad_lens=None):
         head_dim = self.config.decoder_embed_dim // self.config.decoder_attention_heads
 
         qvk_combined_states = self.qvk_combined(hidden_states)
@@ -156,9 +222,25 @@ class OPTSelfAttention(nn.Module):
                 jnp.triu(
                     jnp.full((query_states.shape[1], key_states.shape[1]),
                              -1e10), 1), (0, 1))
+            if left_pad_lens is not None:
+                attention_bias = attention_bias + build_padding_bias(
+                    left_pad_lens, 0, query_states.shape[1],
+                    key_states.shape[1], self.dtype)
         else:
-            cache_key, cache_value, cache_index = attention_cache
+            quantized = self.config.cache_dtype == jnp.int8
+            if quantized:
+                (cache_key, cache_value, cache_key_scale, cache_value_scale,
+                 cache_index) = attention_cache
+            else:
+                cache_key, cache_value, cache_index = attention_cache
             cache_index_ = cache_index[0]
+            if quantized:
+                key_states, key_scale = quantize_int8(key_states)
+                value_states, value_scale = quantize_int8(value_states)
+                cache_key_scale = lax.dynamic_update_slice(
+                    cache_key_scale, key_scale, (0, cache_index_, 0, 0))
+                cache_value_scale = lax.dynamic_update_slice(
+                    cache_value_scale, value_scale, (0, cache_index_, 0, 0))
             key_states = lax.dynamic_update_slice(cache_key, key_states,
                                                   (0, cache_index_, 0, 0))
             value_states = lax.dynamic_update_slice(cache_value, value_states,
@@ -175,8 +257,21 @@ class OPTSelfAttention(nn.Module):
             mask = jnp.arange(max_length) - (cache_index_ + 1)
             attention_bias = jnp.expand_dims(
                 (row_idxs[:, None] <= mask).astype(self.dtype) * -1e10, (0, 1))
-
-            attention_cache = key_states, value_states, cache_index + num_updated_cache_vectors
+            if left_pad_lens is not None:
+                attention_bias = attention_bias + build_padding_bias(
+                    left_pad_lens, cache_index_, num_updated_cache_vectors,
+                    max_length, self.dtype)
+
+            if quantized:
+                attention_cache = (key_states, value_states, cache_key_scale,
+                                   cache_value_scale,
+                                   cache_index + num_updated_cache_vectors)
+                key_states = key_states.astype(self.dtype) * cache_key_scale
+                value_states = value_states.astype(
+                    self.dtype) * cache_value_scale
+            else:
+                attention_cache = (key_states, value_states,
+                                   cache_index + num_updated_cache_vectors)
         attn_weights = nn.attention.dot_product_attention_weights(
             query_states,
             key_states,
@@ -202,22 +297,23 @@ class OPTAttention(nn.Module):
     def setup(self):
         assert self.config.decoder_normalize_before
         self.self = OPTSelfAttention(self.config, dtype=self.dtype)
-        self.dense = nn.Dense(
-            self.config.decoder_embed_dim,
-            dtype=self.dtype,
-        )
+        self.dense = get_dense(self.config,
+                               self.config.decoder_embed_dim,
+                               dtype=self.dtype)
         self.layer_norm = nn.LayerNorm(epsilon=self.config.layer_norm_eps,
                                        dtype=self.dtype)
 
     def __call__(self,
                  hidden_states,
                  output_attentions: bool = False,
-                 attention_cache=None):
+                 attention_cache=None,
+                 left_pad_lens=None):
         residual = hidden_states
         hidden_states = self.layer_norm(hidden_states)
         attn_outputs = self.self(hidden_states,
                                  output_attentions=output_attentions,
-                                 attention_cache=attention_cache)
+                                 attention_cache=attention_cache,
+                                 left_pad_lens=left_pad_lens)
         attn_output = attn_outputs[0]
         attention_cache = attn_outputs[1]
         hidden_states = self.dense(attn_output)
@@ -235,15 +331,13 @@ class OPTFFN(nn.Module):
     dtype: jnp.dtype = jnp.float16  # the dtype of the computation
 
     def setup(self):
-        self.fc1 = nn.Dense(
-            self.config.decoder_ffn_embed_dim,
-            dtype=self.dtype,
-        )
+        self.fc1 = get_dense(self.config,
+                             self.config.decoder_ffn_embed_dim,
+                             dtype=self.dtype)
         self.activation = ACT2FN[self.config.activation_fn]
-        self.fc2 = nn.Dense(
-            self.config.decoder_embed_dim,
-            dtype=self.dtype,
-        )
+        self.fc2 = get_dense(self.config,
+                             self.config.decoder_embed_dim,
+                             dtype=self.dtype)
         self.layer_norm = nn.LayerNorm(epsilon=self.config.layer_norm_eps,
                                        dtype=self.dtype)
 
@@ -272,11 +366,13 @@ class OPTTransformerLayer(nn.Module):
     def __call__(self,
                  hidden_states,
                  output_attentions: bool = False,
-                 attention_cache=None):
+                 attention_cache=None,
+                 left_pad_lens=None):
 
         attention_outputs = self.attention(hidden_states,
                                            output_attentions=output_attentions,
-                                           attention_cache=attention_cache)
+                                           attention_cache=attention_cache,
+                                           left_pad_lens=left_pad_lens)
         attention_output = attention_outputs[0]
         attention_cache = attention_outputs[1]
 
@@ -306,6 +402,7 @@ class OPTTransformerLayerCollection(nn.Module):
         output_hidden_states: bool = False,
         return_dict: bool = True,
         attention_cache=None,
+        left_pad_lens=None,
     ):
         all_attentions = () if output_attentions else None
         all_hidden_states = () if output_hidden_states else None
@@ -329,7 +426,8 @@ class OPTTransformerLayerCollection(nn.Module):
                 layer_attention_cache = attention_cache[i]
             layer_outputs = layer(hidden_states,
                                   output_attentions=output_attentions,
-                                  attention_cache=layer_attention_cache)
+                                  attention_cache=layer_attention_cache,
+                                  left_pad_lens=left_pad_lens)
             hidden_states = layer_outputs[0]
             if attention_cache is not None:
                 new_attention_cache += (layer_outputs[1],)
@@ -371,6 +469,7 @@ class OPTTransformerModule(nn.Module):
         output_hidden_states: bool = False,
         return_dict: bool = True,
         attention_cache=None,
+        left_pad_lens=None,
     ):
         hidden_states = self.embeddings(input_ids, position_ids)
         outputs = self.encoder(
@@ -379,6 +478,7 @@ class OPTTransformerModule(nn.Module):
             output_hidden_states=output_hidden_states,
             return_dict=return_dict,
             attention_cache=attention_cache,
+            left_pad_lens=left_pad_lens,
         )
         hidden_states = outputs[0]
         if self.config.version > 2:
@@ -425,6 +525,7 @@ class OPTForLMModule(nn.Module):
         output_hidden_states: bool = False,
         return_dict: bool = True,
         attention_cache=None,
+        left_pad_lens=None,
     ):
         # Model
         outputs = self.transformers(
@@ -434,6 +535,7 @@ class OPTForLMModule(nn.Module):
             output_hidden_states=output_hidden_states,
             return_dict=return_dict,
             attention_cache=attention_cache,
+            left_pad_lens=left_pad_lens,
         )
 
         hidden_states = outputs[0]
@@ -529,8 +631,10 @@ def init_model_aval(config):
     input_ids = jax.core.ShapedArray((1, 128), jnp.int32)
     position_ids = jax.core.ShapedArray((1, 128), jnp.int32)
     params = jax.eval_shape(model.init, rngkey, input_ids, position_ids)
-    params = jax.tree_map(lambda x: jax.ShapeDtypeStruct(x.shape, config.dtype),
-                          params)
+    # Keep the int8 kernels of QuantizedDense
+    params = jax.tree_map(
+        lambda x: jax.ShapeDtypeStruct(
+            x.shape, jnp.int8 if x.dtype == jnp.int8 else config.dtype), params)
     return model, params
 
 
@@ -538,38 +642,49 @@ def init_cache_aval(config, batch_size):
     """Initialize cache with abstract values (shape-only arrays)."""
     dtype = config.dtype
     head_dim = config.decoder_embed_dim // config.decoder_attention_heads
+    quantized = config.cache_dtype == jnp.int8
 
     all_cache = []
     for i in range(config.decoder_layers):
-        layer_cache = (
-            jax.core.ShapedArray((batch_size, config.max_target_positions,
-                                  config.decoder_attention_heads, head_dim),
-                                 dtype),
-            jax.core.ShapedArray((batch_size, config.max_target_positions,
-                                  config.decoder_attention_heads, head_dim),
-                                 dtype),
-            jax.core.ShapedArray((batch_size,), jnp.int32),
-        )
+        kv_shape = (batch_size, config.max_target_positions,
+                    config.decoder_attention_heads, head_dim)
+        kv_aval = jax.core.ShapedArray(kv_shape,
+                                       jnp.int8 if quantized else dtype)
+        layer_cache = (kv_aval, kv_aval)
+        if quantized:
+            scale_aval = jax.core.ShapedArray(kv_shape[:-1] + (1,), dtype)
+            layer_cache += (scale_aval, scale_aval)
+        layer_cache += (jax.core.ShapedArray((batch_size,), jnp.int32),)
         all_cache.append(layer_cache)
     return tuple(all_cache)
 
 
-def init_cache_np(config, batch_size):
-    """Init cache with numpy arrays."""
+def init_cache_np(config, batch_size, cache_len=None):
+    """Init cache with numpy arrays.
+
+    cache_len defaults to config.max_target_positions. A longer cache can
+    hold left padding tokens on top of the longest sequence.
+    """
     np_dtype = np.float32 if config.dtype == jnp.float32 else np.float16
     head_dim = config.decoder_embed_dim // config.decoder_attention_heads
+    quantized = config.cache_dtype == jnp.int8
+    cache_len = cache_len or config.max_target_positions
 
     all_cache = []
     for i in range(config.decoder_layers):
+        kv_shape = (batch_size, cache_len,
+                    config.decoder_attention_heads, head_dim)
+        kv_dtype = np.int8 if quantized else np_dtype
         layer_cache = (
-            np.zeros((batch_size, config.max_target_positions,
-                      config.decoder_attention_heads, head_dim),
-                     dtype=np_dtype),
-            np.zeros((batch_size, config.max_target_positions,
-                      config.decoder_attention_heads, head_dim),
-                     dtype=np_dtype),
-            np.zeros((batch_size,), np.int32),
+            np.zeros(kv_shape, dtype=kv_dtype),
+            np.zeros(kv_shape, dtype=kv_dtype),
         )
+        if quantized:
+            layer_cache += (
+                np.zeros(kv_shape[:-1] + (1,), dtype=np_dtype),
+                np.zeros(kv_shape[:-1] + (1,), dtype=np_dtype),
+            )
+        layer_cache += (np.zeros((batch_size,), np.int32),)
         all_cache.append(layer_cache)
     return tuple(all_cache)
 
@@ -580,6 +695,18 @@ def build_position_ids(input_ids, padding_idx):
     return position_ids
 
 
+def build_position_ids_with_cache(input_ids, attention_cache, left_pad_lens,
+                                  padding_idx):
+    """Build position ids inside the graph from the index of the cache.
+
+    The left padding tokens get padding_idx, as in build_position_ids.
+    """
+    cache_index = attention_cache[0][-1]
+    offsets = (cache_index[:, None] + jnp.arange(input_ids.shape[1]) -
+               left_pad_lens[:, None])
+    return jnp.maximum(offsets + 1, 0) + padding_idx
+
+
 def inference_step_no_cache(params, batch, apply_func):
     logits = apply_func(params, batch["input_ids"], batch["position_ids"])[0]
     return logits
@@ -587,9 +714,11 @@ def inference_step_no_cache(params, batch, apply_func):
 
 def load_params_np(params, path, config, dummy=False):
     """Load parameterswith numpy arrays."""
+    np_dtype = np.float32 if config.dtype == jnp.float32 else np.float16
     if dummy:
-        np_dtype = np.float32 if config.dtype == jnp.float32 else np.float16
-        return jax.tree_map(lambda x: np.full(x.shape, 1e-9, np_dtype), params)
+        return jax.tree_map(
+            lambda x: np.full(x.shape, 1e-9, np_dtype)
+            if x.dtype != jnp.int8 else np.zeros(x.shape, np.int8), params)
 
     def load_array(key):
         return np.load(os.path.join(path, key))
@@ -609,6 +738,12 @@ def load_params_np(params, path, config, dummy=False):
             else:
                 param_dict = param_dict[key]
 
+    def load_kernel(param_key, kernel):
+        if config.weight_dtype == jnp.int8:
+            kernel, scale = quantize_kernel_int8_np(kernel)
+            load_param(param_key + "_scale", scale.astype(np_dtype))
+        load_param(param_key, kernel)
+
     params = params.unfreeze()
     load_param("params.transformers.embeddings.word_embeddings.embedding",
                load_array("decoder.embed_tokens.weight"))
@@ -629,14 +764,14 @@ def load_params_np(params, path, config, dummy=False):
         dim = wq.shape[-1]
         w_qvk = np.concatenate([wq, wv, wk], axis=0).reshape(
             (3, -1, dim)).transpose([2, 1, 0]).reshape((dim, -1))
-        load_param(param_prefix + "attention.self.qvk_combined.kernel", w_qvk)
+        load_kernel(param_prefix + "attention.self.qvk_combined.kernel", w_qvk)
         bq = load_array(load_prefix + "self_attn.q_proj.bias")
         bk = load_array(load_prefix + "self_attn.k_proj.bias")
         bv = load_array(load_prefix + "self_attn.v_proj.bias")
         b_qvk = np.concatenate([bq, bv, bk], axis=0).reshape(
             (3, dim)).transpose([1, 0]).reshape((-1,))
         load_param(param_prefix + "attention.self.qvk_combined.bias", b_qvk)
-        load_param(
+        load_kernel(
             param_prefix + "attention.dense.kernel",
             np.transpose(load_array(load_prefix + "self_attn.out_proj.weight")))
         load_param(param_prefix + "attention.dense.bias",
@@ -648,12 +783,12 @@ def load_params_np(params, path, config, dummy=False):
         # FFN weights
         load_param(param_prefix + "ffn.fc1.bias",
                    load_array(load_prefix + "fc1.bias"))
-        load_param(param_prefix + "ffn.fc1.kernel",
-                   np.transpose(load_array(load_prefix + "fc1.weight")))
+        load_kernel(param_prefix + "ffn.fc1.kernel",
+                    np.transpose(load_array(load_prefix + "fc1.weight")))
         load_param(param_prefix + "ffn.fc2.bias",
                    load_array(load_prefix + "fc2.bias"))
-        load_param(param_prefix + "ffn.fc2.kernel",
-                   np.transpose(load_array(load_prefix + "fc2.weight")))
+        load_kernel(param_prefix + "ffn.fc2.kernel",
+                    np.transpose(load_array(load_prefix + "fc2.weight")))
         load_param(param_prefix + "ffn.layer_norm.scale",
                    load_array(load_prefix + "final_layer_norm.weight"))
         load_param(param_prefix + "ffn.layer_norm.bias",
@@ -669,10 +804,15 @@ def get_jax_executable(config,
 
     @jax.jit
     def inference_step(params, batch):
+        position_ids = build_position_ids_with_cache(batch["input_ids"],
+                                                     batch["cache"],
+                                                     batch["left_pad_lens"],
+                                                     config.pad)
         output = model.apply(params,
                              batch["input_ids"],
-                             batch["position_ids"],
+                             position_ids,
                              attention_cache=batch["cache"],
+                             left_pad_lens=batch["left_pad_lens"],
                              output_attentions=support_output_attentions,
                              output_hidden_states=support_output_hidden_states)
         return output
@@ -710,11 +850,15 @@ def get_pipeshard_executable(config,
 
         @alpa.parallelize(batch_argnums=(1,), method=method)
         def inference_step_with_cache(params, batch):
+            position_ids = build_position_ids_with_cache(
+                batch["input_ids"], batch["cache"], batch["left_pad_lens"],
+                config.pad)
             output = model.apply(
                 params,
                 batch["input_ids"],
-                batch["position_ids"],
+                position_ids,
                 attention_cache=batch["cache"],
+                left_pad_lens=batch["left_pad_lens"],
                 output_attentions=support_output_attentions,
                 output_hidden_states=support_output_hidden_states)
             return output
@@ -724,10 +868,10 @@ def get_pipeshard_executable(config,
             params, {
                 "input_ids":
                     jax.core.ShapedArray((batch_size, 1), jnp.int32),
-                "position_ids":
-                    jax.core.ShapedArray((batch_size, 1), jnp.int32),
                 "cache":
                     init_cache_aval(config, batch_size),
+                "left_pad_lens":
+                    jax.core.ShapedArray((batch_size,), jnp.int32),
             })
     else:
 
@@ -780,6 +924,13 @@ def load_opt_params_worker_func(self, path, prefix_to_idx, config, shapes,
                 datas.append(loaded_array[indices[i][j][idx]])
             self.put_buffers(uuid, datas)
 
+    def load_kernel(param_key, kernel):
+        if config.weight_dtype == jnp.int8:
+            kernel, scale = quantize_kernel_int8_np(kernel)
+            np_dtype = np.float32 if config.dtype == jnp.float32 else np.float16
+            load_param(param_key + "_scale", scale.astype(np_dtype))
+        load_param(param_key, kernel)
+
     load_param("params.transformers.embeddings.word_embeddings.embedding",
                load_array("decoder.embed_tokens.weight"))
     load_param("params.transformers.embeddings.position_embeddings.embedding",
@@ -807,14 +958,14 @@ def load_opt_params_worker_func(self, path, prefix_to_idx, config, shapes,
         dim = wq.shape[-1]
         w_qvk = np.concatenate([wq, wv, wk], axis=0).reshape(
             (3, -1, dim)).transpose([2, 1, 0]).reshape((dim, -1))
-        load_param(param_prefix + "attention.self.qvk_combined.kernel", w_qvk)
+        load_kernel(param_prefix + "attention.self.qvk_combined.kernel", w_qvk)
         bq = load_array(load_prefix + "self_attn.q_proj.bias")
         bk = load_array(load_prefix + "self_attn.k_proj.bias")
         bv = load_array(load_prefix + "self_attn.v_proj.bias")
         b_qvk = np.concatenate([bq, bv, bk], axis=0).reshape(
             (3, dim)).transpose([1, 0]).reshape((-1,))
         load_param(param_prefix + "attention.self.qvk_combined.bias", b_qvk)
-        load_param(
+        load_kernel(
             param_prefix + "attention.dense.kernel",
             np.transpose(load_array(load_prefix + "self_attn.out_proj.weight")))
         load_param(param_prefix + "attention.dense.bias",
@@ -826,12 +977,12 @@ def load_opt_params_worker_func(self, path, prefix_to_idx, config, shapes,
         # FFN weights
         load_param(param_prefix + "ffn.fc1.bias",
                    load_array(load_prefix + "fc1.bias"))
-        load_param(param_prefix + "ffn.fc1.kernel",
-                   np.transpose(load_array(load_prefix + "fc1.weight")))
+        load_kernel(param_prefix + "ffn.fc1.kernel",
+                    np.transpose(load_array(load_prefix + "fc1.weight")))
         load_param(param_prefix + "ffn.fc2.bias",
                    load_array(load_prefix + "fc2.bias"))
-        load_param(param_prefix + "ffn.fc2.kernel",
-                   np.transpose(load_array(load_prefix + "fc2.weight")))
+        load_kernel(param_prefix + "ffn.fc2.kernel",
+                    np.transpose(load_array(load_prefix + "fc2.weight")))
         load_param(param_prefix + "ffn.layer_norm.scale",
                    load_array(load_prefix + "final_layer_norm.weight"))
         load_param(param_prefix + "ffn.layer_norm.bias",
@@ -944,3 +1095,24 @@ def init_cache_dis_array(executable, config, batch_size, dummy=False):
             flat_info, flat_args)
     alpa.global_config.use_dummy_value_for_benchmarking = False
     return ret
+
+
+def init_left_pad_lens_dis_array(executable, left_pad_lens):
+    """Shard left_pad_lens once, so that all steps of a prompt can reuse it.
+
+    left_pad_lens is a batch var like the attention cache, so the shards are
+    marked with skip_shard_args_check to take the fast path.
+    """
+    _, batch_info = executable.get_input_placement_specs()
+    info = batch_info["left_pad_lens"]
+    ret = executable.mesh_group.shard_args_to_arrays([info], [left_pad_lens])[0]
+    if isinstance(ret, ReplicatedDistributedArray):
+        arrays = [
+            ret.get_replica_on_mesh(executable.mesh_group[mesh_id])
+            for mesh_id in info.mesh_ids
+        ]
+    else:
+        arrays = [ret]
+    for x in arrays:
+        x.skip_shard_args_check = True
+    return ret
@@ -2,6 +2,7 @@ from functools import partial
 
 from jax import xla, jit
 from jax.core import Primitive
+from jax.tree_util import tree_map
 from jax._src.lib import xla_client as xc
 from transformers.generation_utils import dataclass
 
@@ -44,6 +45,12 @@ def jax_index_select(input, index, dim=0):
     return index_select_p.bind(input, index, dim=dim)
 
 
+@jit
+def jax_index_select_tree(inputs, index):
+    """Index select all arrays in a pytree along dim 0 with one jit call."""
+    return tree_map(lambda x: index_select_p.bind(x, index, dim=0), inputs)
+
+
 def _index_select_eval(input, index, dim):
     return input
 
@@ -1,4 +1,6 @@
 """Test the correctness of cache implementation."""
+import functools
+
 import jax
 import jax.numpy as jnp
 import numpy as np
@@ -8,7 +10,8 @@ from opt_serving.model.opt_model import (get_opt_config, init_model_aval,
                                          inference_step_no_cache,
                                          init_cache_np,
                                          build_position_ids,
-                                         load_params_np)
+                                         load_params_np,
+                                         get_jax_executable)
 
 
 def print_params(params, prefix=""):
@@ -19,32 +22,20 @@ def print_params(params, prefix=""):
             print(prefix + key, value.shape)
 
 
-def test_opt_125M(decompose_input):
-    print("Testing cache with decompose_input=%s" % decompose_input)
-    name = "125M"
+@functools.lru_cache(maxsize=4)
+def load_model(name):
+    """Load the model once and share it (and its jitted steps) across tests."""
     config = get_opt_config(name, dtype=jnp.float32)
     np_weights_folder = f"/home/ubuntu/opt_weights/{name}_np"
-    batch_size = 1
-
-    # Init model
-    input_ids = np.array([[5625, 16, 10, 2721, 183, 8, 38, 236, 7]],
-                         dtype=np.int32)
-    input_ids = np.tile(input_ids, [batch_size, 1])
-    position_ids = build_position_ids(input_ids, config.pad)
-    print("input_ids", input_ids)
 
     model, params = init_model_aval(config)
     params = load_params_np(params, np_weights_folder, config)
     params = jax.tree_map(jnp.array, params)
 
-    # Get expected results
-    logits_no_cache = inference_step_no_cache(params, {
-        "input_ids": input_ids,
-        "position_ids": position_ids,
-    }, model.apply)
-    print("logits_no_cache", logits_no_cache)
+    @jax.jit
+    def inference_step(params, batch):
+        return inference_step_no_cache(params, batch, model.apply)
 
-    # JIT
     @jax.jit
     def inference_step_with_cache(params, batch):
         print("traced")
@@ -54,10 +45,36 @@ def test_opt_125M(decompose_input):
                              attention_cache=batch["cache"])
         return output.logits, output.attention_cache
 
+    return config, params, inference_step, inference_step_with_cache
+
+
+def test_opt_125M(decompose_input):
+    print("Testing cache with decompose_input=%s" % decompose_input)
+    name = "125M"
+    config, params, inference_step, inference_step_with_cache = load_model(
+        name)
+    batch_size = 1
+
+    # Init inputs
+    input_ids = np.array([[5625, 16, 10, 2721, 183, 8, 38, 236, 7]],
+                         dtype=np.int32)
+    input_ids = np.tile(input_ids, [batch_size, 1])
+    position_ids = build_position_ids(input_ids, config.pad)
+    print("input_ids", input_ids)
+
+    # Get expected results
+    logits_no_cache = inference_step(params, {
+        "input_ids": input_ids,
+        "position_ids": position_ids,
+    })
+    print("logits_no_cache", logits_no_cache)
+
     cache = init_cache_np(config, input_ids.shape[0])
 
     if decompose_input:
         # Decompose input so that all input lengths are one.
+        # Compare all steps at the end to avoid syncing after every step.
+        logits_steps = []
         for i in range(input_ids.shape[1]):
             input_ids_step = input_ids[:, i:i + 1]
             position_ids_step = np.full_like(input_ids_step, i + config.pad + 1)
@@ -67,7 +84,8 @@ def test_opt_125M(decompose_input):
                     "position_ids": position_ids_step,
                     "cache": cache
                 })
-            assert_allclose(logits_step, logits_no_cache[:, i:i + 1])
+            logits_steps.append(logits_step)
+        assert_allclose(jnp.concatenate(logits_steps, axis=1), logits_no_cache)
     else:
         # Same as inference_step_no_cache that has input length > 1.
         logits_step, cache = inference_step_with_cache(
@@ -79,6 +97,157 @@ def test_opt_125M(decompose_input):
         assert_allclose(logits_step, logits_no_cache)
 
 
+def build_left_padded_batch(input_ids, num_pads, padding_idx):
+    """Batch input_ids with its prefix that is left padded to the same length.
+
+    Return the batch and the number of padding tokens of each row.
+    """
+    num_rows = input_ids.shape[0]
+    pads = np.full((num_rows, num_pads), padding_idx, np.int32)
+    padded_input_ids = np.concatenate([pads, input_ids[:, :-num_pads]], axis=1)
+    left_pad_lens = np.array([0] * num_rows + [num_pads] * num_rows,
+                             dtype=np.int32)
+    return np.concatenate([input_ids, padded_input_ids]), left_pad_lens
+
+
+def run_no_cache(inference_step, params, input_ids, padding_idx):
+    return inference_step(
+        params, {
+            "input_ids": input_ids,
+            "position_ids": build_position_ids(input_ids, padding_idx),
+        })
+
+
+def test_opt_125M_left_padding():
+    print("Testing left padding")
+    name = "125M"
+    config, params, inference_step, _ = load_model(name)
+    model, _ = init_model_aval(config)
+
+    @jax.jit
+    def inference_step_with_padding(params, batch):
+        return model.apply(params,
+                           batch["input_ids"],
+                           batch["position_ids"],
+                           left_pad_lens=batch["left_pad_lens"]).logits
+
+    input_ids = np.array([[5625, 16, 10, 2721, 183, 8, 38, 236, 7]],
+                         dtype=np.int32)
+    num_pads = 3
+    batch_input_ids, left_pad_lens = build_left_padded_batch(
+        input_ids, num_pads, config.pad)
+
+    # Get expected results
+    logits_no_padding = run_no_cache(inference_step, params, input_ids,
+                                     config.pad)
+    logits_short = run_no_cache(inference_step, params,
+                                input_ids[:, :-num_pads], config.pad)
+
+    logits = inference_step_with_padding(
+        params, {
+            "input_ids": batch_input_ids,
+            "position_ids": build_position_ids(batch_input_ids, config.pad),
+            "left_pad_lens": left_pad_lens,
+        })
+    assert_allclose(logits[:1], logits_no_padding)
+    assert_allclose(logits[1:, num_pads:], logits_short)
+
+
+def run_jax_executable(config, params, input_ids, left_pad_lens):
+    """Prefill all tokens but the last one with the step of
+    get_jax_executable, then decode the last one.
+
+    The position ids are computed inside the step from the cache index.
+    Return the logits of all tokens.
+    """
+    executable, _ = get_jax_executable(config)
+    cache = init_cache_np(config, input_ids.shape[0])
+    output = executable(
+        params, {
+            "input_ids": input_ids[:, :-1],
+            "cache": cache,
+            "left_pad_lens": left_pad_lens,
+        })
+    logits_prefill = output.logits
+    output = executable(
+        params, {
+            "input_ids": input_ids[:, -1:],
+            "cache": output.attention_cache,
+            "left_pad_lens": left_pad_lens,
+        })
+    return jnp.concatenate([logits_prefill, output.logits], axis=1)
+
+
+def test_opt_125M_jax_executable():
+    print("Testing get_jax_executable")
+    name = "125M"
+    config, params, inference_step, _ = load_model(name)
+
+    input_ids = np.array([[5625, 16, 10, 2721, 183, 8, 38, 236, 7]],
+                         dtype=np.int32)
+    num_pads = 3
+    batch_input_ids, left_pad_lens = build_left_padded_batch(
+        input_ids, num_pads, config.pad)
+
+    # Get expected results
+    logits_no_padding = run_no_cache(inference_step, params, input_ids,
+                                     config.pad)
+    logits_short = run_no_cache(inference_step, params,
+                                input_ids[:, :-num_pads], config.pad)
+
+    logits = run_jax_executable(config, params, batch_input_ids, left_pad_lens)
+    assert_allclose(logits[:1], logits_no_padding)
+    assert_allclose(logits[1:, num_pads:], logits_short)
+
+
+def test_opt_125M_int8_cache():
+    print("Testing int8 cache")
+    name = "125M"
+    config, params, _, _ = load_model(name)
+    int8_config = get_opt_config(name, dtype=jnp.float32, cache_dtype=jnp.int8)
+
+    input_ids = np.array([[5625, 16, 10, 2721, 183, 8, 38, 236, 7]],
+                         dtype=np.int32)
+    batch_input_ids, left_pad_lens = build_left_padded_batch(
+        input_ids, 3, config.pad)
+
+    logits = run_jax_executable(config, params, batch_input_ids, left_pad_lens)
+    logits_int8 = run_jax_executable(int8_config, params, batch_input_ids,
+                                     left_pad_lens)
+    # Each cached vector is rounded to within 1/254 of its largest entry.
+    # The errors accumulate over the layers, so use a loose tolerance.
+    assert_allclose(logits_int8, logits, rtol=5e-2, atol=5e-1)
+
+
+def test_opt_125M_int8_weights():
+    print("Testing int8 weights")
+    name = "125M"
+    config, params, inference_step, _ = load_model(name)
+    int8_config = get_opt_config(name, dtype=jnp.float32, weight_dtype=jnp.int8)
+    int8_model, int8_params = init_model_aval(int8_config)
+    int8_params = load_params_np(int8_params,
+                                 f"/home/ubuntu/opt_weights/{name}_np",
+                                 int8_config)
+    int8_params = jax.tree_map(jnp.array, int8_params)
+
+    @jax.jit
+    def int8_inference_step(params, batch):
+        return inference_step_no_cache(params, batch, int8_model.apply)
+
+    input_ids = np.array([[5625, 16, 10, 2721, 183, 8, 38, 236, 7]],
+                         dtype=np.int32)
+    logits = run_no_cache(inference_step, params, input_ids, config.pad)
+    logits_int8 = run_no_cache(int8_inference_step, int8_params, input_ids,
+                               config.pad)
+    # Each kernel column is rounded to within 1/254 of its largest entry.
+    # The errors accumulate over the layers, so use a loose tolerance.
+    assert_allclose(logits_int8, logits, rtol=1e-1, atol=1.0)
+
+
 if __name__ == "__main__":
     test_opt_125M(False)
     test_opt_125M(True)
+    test_opt_125M_left_padding()
+    test_opt_125M_jax_executable()
+    test_opt_125M_int8_cache()
+    test_opt_125M_int8_weights()
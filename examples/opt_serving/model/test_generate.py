@@ -0,0 +1,125 @@
+"""Test the native generation loops against huggingface's generator."""
+import numpy as np
+import torch
+from transformers import AutoTokenizer
+from transformers.generation_utils import GenerationMixin
+
+from opt_serving.model.wrapper import (get_model, InferenceFuncConfig,
+                                       WrappedInferenceFunc)
+
+test_prompts = [
+    "Paris is the capital city of",
+    "Computer science is the study of computation and",
+]
+
+
+def load_model_and_inputs(name):
+    model = get_model(name, "cpu", path="")
+    tokenizer = AutoTokenizer.from_pretrained(name, use_fast=False)
+    # Left pad the prompts of different lengths into one batch
+    tokenizer.padding_side = "left"
+    inputs = tokenizer(test_prompts, return_tensors="pt", padding=True)
+    return model, inputs
+
+
+def check_generate(model, inputs, **kwargs):
+    """Check that the native loop returns the same sequences as huggingface's
+    generator, and return both outputs."""
+    output = model.generate(input_ids=inputs.input_ids,
+                            attention_mask=inputs.attention_mask,
+                            do_sample=False,
+                            return_dict_in_generate=True,
+                            **kwargs)
+    # huggingface's generator only returns sequence scores with output_scores
+    expected = GenerationMixin.generate(model,
+                                        input_ids=inputs.input_ids,
+                                        attention_mask=inputs.attention_mask,
+                                        do_sample=False,
+                                        return_dict_in_generate=True,
+                                        output_scores=True,
+                                        **kwargs)
+    print("sequences", output.sequences)
+    assert torch.equal(output.sequences, expected.sequences)
+    return output, expected
+
+
+def test_greedy_opt_125M():
+    print("Testing greedy search")
+    model, inputs = load_model_and_inputs("facebook/opt-125m")
+    kwargs = {"max_length": 24, "num_beams": 1}
+
+    output, _ = check_generate(model, inputs, **kwargs)
+
+    # Use a token generated early as EOS, so that a sequence finishes early
+    eos_token_id = int(output.sequences[0, inputs.input_ids.shape[1] + 2])
+    check_generate(model, inputs, eos_token_id=eos_token_id, **kwargs)
+
+
+def test_beam_search_opt_125M():
+    print("Testing beam search")
+    model, inputs = load_model_and_inputs("facebook/opt-125m")
+    kwargs = {"max_length": 24, "num_beams": 4, "num_return_sequences": 2}
+
+    output, expected = check_generate(model, inputs, **kwargs)
+    assert torch.allclose(output.sequences_scores,
+                          expected.sequences_scores,
+                          atol=1e-4)
+
+    # Use a token generated early as EOS, so that beams finish early
+    eos_token_id = int(output.sequences[0, inputs.input_ids.shape[1] + 2])
+    output, expected = check_generate(model,
+                                      inputs,
+                                      eos_token_id=eos_token_id,
+                                      **kwargs)
+    assert torch.allclose(output.sequences_scores,
+                          expected.sequences_scores,
+                          atol=1e-4)
+
+
+class RecordingMesh:
+    """A device mesh that records the sharding specs it is given."""
+
+    def __init__(self, num_devices):
+        self.num_devices = num_devices
+        self.calls = []
+
+    def shard_args_to_arrays(self, avals, indices, specs, args):
+        self.calls.append((avals[0], indices[0], specs[0]))
+        return args
+
+
+def test_beam_idx_reuse():
+    print("Testing beam_idx reuse")
+    model = WrappedInferenceFunc(None, InferenceFuncConfig(), None, None)
+
+    # The host buffer is reused for the same shape
+    beam_idx = model._copy_beam_idx_to_host(torch.tensor([1, 0, 3, 2]))
+    assert beam_idx.dtype == np.int32
+    assert np.array_equal(beam_idx, [1, 0, 3, 2])
+    buffer = model.beam_idx_buffer
+    beam_idx = model._copy_beam_idx_to_host(torch.tensor([0, 0, 2, 2]))
+    assert model.beam_idx_buffer is buffer
+    assert np.array_equal(beam_idx, [0, 0, 2, 2])
+
+    # The host buffer is reallocated when the shape changes
+    beam_idx = model._copy_beam_idx_to_host(torch.tensor([5, 4, 3, 2, 1, 0]))
+    assert model.beam_idx_buffer is not buffer
+    assert model.beam_idx_buffer.shape == (6,)
+    assert beam_idx.dtype == np.int32
+    assert np.array_equal(beam_idx, [5, 4, 3, 2, 1, 0])
+
+    # The sharding of beam_idx is computed once per mesh
+    mesh_a, mesh_b = RecordingMesh(2), RecordingMesh(4)
+    for _ in range(2):
+        assert model._shard_beam_idx(beam_idx, mesh_a) is beam_idx
+        model._shard_beam_idx(beam_idx, mesh_b)
+    assert mesh_a.calls[0][0] is mesh_a.calls[1][0]
+    assert mesh_a.calls[0][1] is mesh_a.calls[1][1]
+    assert len(mesh_a.calls[0][1]) == 2
+    assert len(mesh_b.calls[0][1]) == 4
+
+
+if __name__ == "__main__":
+    test_greedy_opt_125M()
+    test_beam_search_opt_125M()
+    test_beam_idx_reuse()
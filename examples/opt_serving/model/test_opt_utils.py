@@ -0,0 +1,39 @@
+"""Test the jax utilities of the generation loops."""
+import jax
+import jax.numpy as jnp
+import numpy as np
+
+from alpa.testing import assert_allclose
+from opt_serving.model.opt_utils import jax_index_select_tree
+
+
+def test_jax_index_select_tree():
+    print("Testing jax_index_select_tree")
+    bs, seq_len, num_heads, head_dim = 4, 8, 2, 16
+    rng = np.random.RandomState(0)
+
+    def rand(dtype):
+        shape = (bs, seq_len, num_heads, head_dim)
+        return jnp.asarray(rng.rand(*shape).astype(dtype))
+
+    # Mimic the cache: one (key, value, index) tuple per layer
+    def layer_cache():
+        return (rand(np.float32), rand(np.float16),
+                jnp.arange(bs, dtype=jnp.int32))
+
+    cache = (layer_cache(), layer_cache())
+    index = jnp.array([2, 2, 0, 3], dtype=jnp.int32)
+
+    selected = jax_index_select_tree(cache, index)
+    expected = jax.tree_map(lambda x: jnp.take(x, index, axis=0), cache)
+
+    assert (jax.tree_util.tree_structure(selected) ==
+            jax.tree_util.tree_structure(expected))
+    for x, y in zip(jax.tree_util.tree_leaves(selected),
+                    jax.tree_util.tree_leaves(expected)):
+        assert x.dtype == y.dtype
+        assert_allclose(np.asarray(x), np.asarray(y))
+
+
+if __name__ == "__main__":
+    test_jax_index_select_tree()
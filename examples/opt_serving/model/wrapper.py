@@ -6,6 +6,7 @@ import alpa
 from alpa.device_mesh import DistributedArray
 from alpa.mesh_executable import get_index_select_mesh_executable
 import jax
+import jax.dlpack
 from jax import xla
 from jax import ShapeDtypeStruct, ShapedArray
 from jax.interpreters import pxla
@@ -13,15 +14,20 @@ from jax.interpreters.pxla import NoSharding, Replicated, ShardingSpec
 import jax.numpy as jnp
 import numpy as np
 import torch
-from transformers.generation_utils import GenerationMixin, ModelOutput, dataclass
+import torch.utils.dlpack
+from transformers.generation_utils import (GenerationMixin, ModelOutput,
+                                           BeamSearchDecoderOnlyOutput,
+                                           GreedySearchDecoderOnlyOutput,
+                                           dataclass)
 from transformers import OPTForCausalLM, GPT2LMHeadModel
 
 from opt_serving.model.opt_model import (
     get_opt_config, get_pipeshard_executable, load_params_dis_array,
-    init_cache_dis_array, load_params_np, init_cache_np, get_jax_executable)
+    init_cache_dis_array, load_params_np, init_cache_np, get_jax_executable,
+    init_left_pad_lens_dis_array)
 from opt_serving.model.opt_utils import (TransformerModelConfig,
-                                                  jax_index_select,
-                                                  is_power_of_two)
+                                         jax_index_select_tree,
+                                         is_power_of_two)
 
 
 @dataclass
@@ -73,23 +79,38 @@ class WrappedInferenceFunc(GenerationMixin):
     Wrap an inference func as a GenerationMixin.
     This class implements the minimal interface for using huggingface's generator.
 
-    This class also decomposes the first call of prompt during generation to one token by one token.
+    The whole prompt is fed to the inference func in a single prefill call.
+    If attention_mask_after_prefill is False, the inference func only reads
+    the attention mask of the prompt, so the native generation loops do not
+    pass it to the decoding steps.
     """
 
-    def __init__(self, inference_func, config, executable, transformer_config):
+    def __init__(self,
+                 inference_func,
+                 config,
+                 executable,
+                 transformer_config,
+                 attention_mask_after_prefill=True):
         self.inference_func = inference_func
         self.config = config
         self.main_input_name = "input_ids"
         self.executable = executable
         self.transformer_config = transformer_config
+        self.attention_mask_after_prefill = attention_mask_after_prefill
         self.index_select_executables = {}
         self.cache_location = None
+        self.beam_idx_buffer = None
+        self.beam_idx_shardings = {}
 
     def forward(self, attention_mask):
         # This function is never used
         raise NotImplementedError()
 
-    def prepare_inputs_for_generation(self, input_ids, past=None, **kwargs):
+    def prepare_inputs_for_generation(self,
+                                      input_ids,
+                                      past=None,
+                                      attention_mask=None,
+                                      **kwargs):
         # only last token for input_ids if past is defined in kwargs
         if past:
             input_ids = input_ids[:, -1].unsqueeze(-1)
@@ -97,22 +118,290 @@ class WrappedInferenceFunc(GenerationMixin):
         return {
             "input_ids": input_ids,
             "past_key_values": past,
+            "attention_mask": attention_mask,
         }
 
     def __call__(self,
                  input_ids,
                  past_key_values=None,
+                 attention_mask=None,
                  output_attentions=None,
                  output_hidden_states=None,
                  return_dict=None):
-        # Decompose the call to token by token
-        for i in range(input_ids.shape[1]):
-            ret = self.inference_func(input_ids[:, i:i + 1],
-                                      past_key_values,
-                                      output_hidden_states=output_hidden_states,
-                                      output_attentions=output_attentions)
-            past_key_values = ret.past_key_values
-        return ret
+        return self.inference_func(input_ids,
+                                   past_key_values,
+                                   attention_mask=attention_mask,
+                                   output_hidden_states=output_hidden_states,
+                                   output_attentions=output_attentions)
+
+    # The arguments handled by the native greedy and beam search loops.
+    # Calls with any other argument fall back to huggingface's generator.
+    native_generate_args = {
+        "max_length", "num_beams", "do_sample", "attention_mask",
+        "num_return_sequences", "length_penalty", "early_stopping",
+        "pad_token_id", "eos_token_id", "return_dict_in_generate",
+        "output_attentions", "output_hidden_states"
+    }
+
+    @torch.no_grad()
+    def generate(self, input_ids=None, **kwargs):
+        use_native = (input_ids is not None and
+                      set(kwargs.keys()) <= self.native_generate_args and
+                      not kwargs.get("do_sample", self.config.do_sample) and
+                      not kwargs.get("output_attentions") and
+                      not kwargs.get("output_hidden_states"))
+        num_beams = kwargs.get("num_beams", self.config.num_beams)
+        num_return_sequences = kwargs.get("num_return_sequences",
+                                          self.config.num_return_sequences)
+        eos_token_id = kwargs.get("eos_token_id", self.config.eos_token_id)
+        pad_token_id = kwargs.get("pad_token_id", self.config.pad_token_id)
+        if pad_token_id is None:
+            # Same as huggingface's generator
+            pad_token_id = eos_token_id
+        common_args = {
+            "max_length":
+                kwargs.get("max_length", getattr(self.config, "max_length",
+                                                 None)),
+            "attention_mask":
+                kwargs.get("attention_mask"),
+            "pad_token_id":
+                pad_token_id,
+            "eos_token_id":
+                eos_token_id,
+            "return_dict_in_generate":
+                kwargs.get("return_dict_in_generate",
+                           self.config.return_dict_in_generate),
+        }
+
+        if use_native and num_beams > 1:
+            return self.beam_search_generate(
+                input_ids,
+                num_beams=num_beams,
+                num_return_sequences=num_return_sequences,
+                length_penalty=kwargs.get("length_penalty",
+                                          self.config.length_penalty),
+                early_stopping=kwargs.get("early_stopping",
+                                          self.config.early_stopping),
+                **common_args)
+        if use_native and num_return_sequences == 1:
+            return self.greedy_generate(input_ids, **common_args)
+        return super().generate(input_ids=input_ids, **kwargs)
+
+    @torch.no_grad()
+    def greedy_generate(self,
+                        input_ids,
+                        max_length,
+                        attention_mask=None,
+                        pad_token_id=1,
+                        eos_token_id=2,
+                        return_dict_in_generate=False):
+        """Greedy search without huggingface's logits processors and
+        stopping criteria.
+
+        Finished sequences are padded with pad_token_id, and the loop stops
+        once all sequences emit eos_token_id or reach max_length.
+        """
+        if max_length is None:
+            max_length = self.transformer_config.seq_len
+        unfinished = torch.ones((input_ids.shape[0],),
+                                dtype=torch.bool,
+                                device=input_ids.device)
+
+        full_attention_mask = self._preallocate_attention_mask(
+            attention_mask, max_length)
+
+        past = None
+        next_input_ids = input_ids
+        while input_ids.shape[1] < max_length:
+            out = self(next_input_ids,
+                       past_key_values=past,
+                       attention_mask=attention_mask)
+            next_tokens = out.logits[:, -1, :].argmax(dim=-1)
+            next_tokens = torch.where(
+                unfinished, next_tokens,
+                torch.full_like(next_tokens, pad_token_id))
+            input_ids = torch.cat([input_ids, next_tokens.unsqueeze(1)], dim=-1)
+            unfinished = unfinished & (next_tokens != eos_token_id)
+
+            if input_ids.shape[1] >= max_length or not unfinished.any():
+                break
+
+            past = out.past_key_values
+            next_input_ids = next_tokens.unsqueeze(1)
+            attention_mask = (None if full_attention_mask is None else
+                              full_attention_mask[:, :input_ids.shape[1]])
+
+        if return_dict_in_generate:
+            return GreedySearchDecoderOnlyOutput(sequences=input_ids)
+        return input_ids
+
+    @torch.no_grad()
+    def beam_search_generate(self,
+                             input_ids,
+                             max_length,
+                             num_beams,
+                             attention_mask=None,
+                             num_return_sequences=1,
+                             length_penalty=1.0,
+                             early_stopping=False,
+                             pad_token_id=1,
+                             eos_token_id=2,
+                             return_dict_in_generate=False):
+        """Beam search without huggingface's BeamSearchScorer.
+
+        This follows the search of BeamSearchScorer: every step keeps the
+        top 2 * num_beams candidates, moves the ones ending with
+        eos_token_id to the finished hypotheses, and continues with the
+        best num_beams others. The bookkeeping runs as batched tensor ops on
+        the device of the logits instead of per-candidate Python loops.
+        """
+        batch_size, cur_len = input_ids.shape
+        device = input_ids.device
+        if max_length is None:
+            max_length = self.transformer_config.seq_len
+        if num_return_sequences > num_beams:
+            raise ValueError(
+                "`num_return_sequences` has to be smaller or equal to `num_beams`."
+            )
+
+        input_ids = input_ids.repeat_interleave(num_beams, dim=0)
+        if attention_mask is not None:
+            attention_mask = attention_mask.repeat_interleave(num_beams, dim=0)
+        # The beams of an input have the same mask rows, so the mask never
+        # needs to be reordered.
+        full_attention_mask = self._preallocate_attention_mask(
+            attention_mask, max_length)
+
+        # Only the first beam is alive at the start, so that the first step
+        # does not pick the same token from identical beams.
+        beam_scores = torch.zeros((batch_size, num_beams), device=device)
+        beam_scores[:, 1:] = -1e9
+        beam_scores = beam_scores.view(-1)
+        beam_offsets = (torch.arange(batch_size, device=device) *
+                        num_beams).unsqueeze(1)
+        ranks = torch.arange(2 * num_beams, device=device)
+
+        # The best num_beams finished hypotheses of each input, sorted by
+        # their length-normalized scores. Empty slots have -inf scores.
+        hyp_scores = torch.full((batch_size, num_beams),
+                                -float("inf"),
+                                device=device)
+        hyp_ids = torch.full((batch_size, num_beams, max_length),
+                             pad_token_id,
+                             dtype=input_ids.dtype,
+                             device=device)
+        hyp_lens = torch.zeros((batch_size, num_beams),
+                               dtype=torch.long,
+                               device=device)
+        done = torch.zeros((batch_size,), dtype=torch.bool, device=device)
+
+        def add_hyps(scores, ids, valid):
+            nonlocal hyp_scores, hyp_ids, hyp_lens
+            lens = torch.full_like(hyp_lens[:, :1],
+                                   cur_len).expand(-1, scores.shape[1])
+            scores = scores.masked_fill(~valid, -float("inf"))
+            ids = torch.nn.functional.pad(ids, (0, max_length - ids.shape[2]),
+                                          value=pad_token_id)
+            hyp_scores, idx = torch.topk(torch.cat([hyp_scores, scores], 1),
+                                         num_beams,
+                                         dim=1)
+            hyp_ids = torch.cat([hyp_ids, ids], 1).gather(
+                1,
+                idx.unsqueeze(2).expand(-1, -1, max_length))
+            hyp_lens = torch.cat([hyp_lens, lens], 1).gather(1, idx)
+
+        past = None
+        next_input_ids = input_ids
+        while True:
+            out = self(next_input_ids,
+                       past_key_values=past,
+                       attention_mask=attention_mask)
+            log_probs = torch.log_softmax(out.logits[:, -1, :].float(), dim=-1)
+            vocab_size = log_probs.shape[-1]
+
+            scores = (beam_scores.unsqueeze(1) + log_probs).view(
+                batch_size, num_beams * vocab_size)
+            cand_scores, cand_idx = torch.topk(scores, 2 * num_beams, dim=1)
+            cand_tokens = cand_idx % vocab_size
+            cand_beams = cand_idx // vocab_size + beam_offsets
+            is_eos = cand_tokens == eos_token_id
+
+            # EOS candidates within the top num_beams finish their beams.
+            # A finished hypothesis does not include the EOS in its length.
+            eos_ids = torch.cat([
+                input_ids[cand_beams[:, :num_beams]],
+                torch.full_like(cand_tokens[:, :num_beams, None], eos_token_id)
+            ], 2)
+            add_hyps(cand_scores[:, :num_beams] / cur_len**length_penalty,
+                     eos_ids, is_eos[:, :num_beams] & ~done.unsqueeze(1))
+
+            # Continue with the best num_beams candidates without EOS
+            order = (is_eos.long() * 2 * num_beams +
+                     ranks).argsort(dim=1)[:, :num_beams]
+            beam_scores = cand_scores.gather(1, order)
+            next_tokens = cand_tokens.gather(1, order)
+            beam_idx = cand_beams.gather(1, order)
+
+            # Finished inputs only extend their first beam with pad tokens
+            beam_scores = beam_scores.masked_fill(done.unsqueeze(1), 0)
+            next_tokens = next_tokens.masked_fill(done.unsqueeze(1),
+                                                  pad_token_id)
+            beam_idx = torch.where(done.unsqueeze(1), beam_offsets, beam_idx)
+
+            # An input is done once no candidate can beat its worst
+            # finished hypothesis
+            worst_scores = hyp_scores[:, -1]
+            can_stop = (worst_scores >=
+                        cand_scores[:, 0] / cur_len**length_penalty)
+            if early_stopping:
+                can_stop = torch.ones_like(can_stop)
+            done = done | (torch.isfinite(worst_scores) & can_stop)
+
+            beam_scores = beam_scores.view(-1)
+            beam_idx = beam_idx.view(-1)
+            input_ids = torch.cat(
+                [input_ids[beam_idx],
+                 next_tokens.view(-1, 1)], dim=-1)
+            cur_len += 1
+
+            if cur_len >= max_length or done.all():
+                break
+
+            past = self._reorder_cache(out.past_key_values, beam_idx)
+            next_input_ids = input_ids[:, -1:]
+            attention_mask = (None if full_attention_mask is None else
+                              full_attention_mask[:, :cur_len])
+
+        # The running beams of unfinished inputs are hypotheses as well
+        add_hyps(
+            beam_scores.view(batch_size, num_beams) / cur_len**length_penalty,
+            input_ids.view(batch_size, num_beams, cur_len),
+            ~done.unsqueeze(1).expand(-1, num_beams))
+
+        best_scores = hyp_scores[:, :num_return_sequences].reshape(-1)
+        best_lens = hyp_lens[:, :num_return_sequences].reshape(-1)
+        # Keep room for the EOS of the longest finished hypothesis
+        sent_max_len = min(best_lens.max().item() + 1, max_length)
+        sequences = hyp_ids[:, :num_return_sequences].reshape(
+            -1, max_length)[:, :sent_max_len]
+
+        if return_dict_in_generate:
+            return BeamSearchDecoderOnlyOutput(sequences=sequences,
+                                               sequences_scores=best_scores)
+        return sequences
+
+    def _preallocate_attention_mask(self, attention_mask, max_length):
+        """Copy the mask of the prompt into a mask of ones with max_length
+        columns, so that the decoding steps can use views of it.
+
+        Return None if the decoding steps do not need the mask.
+        """
+        if attention_mask is None or not self.attention_mask_after_prefill:
+            return None
+        full_attention_mask = attention_mask.new_ones(
+            (attention_mask.shape[0], max_length))
+        full_attention_mask[:, :attention_mask.shape[1]] = attention_mask
+        return full_attention_mask
 
     def _reorder_cache(self, past, beam_idx):
         # Reorder cache for beam search
@@ -128,11 +417,7 @@ class WrappedInferenceFunc(GenerationMixin):
         # Jax (single-device)
         if not isinstance(past[0][0], DistributedArray):
             beam_idx = jnp.array(beam_idx.to("cpu").numpy())
-            return tuple(
-                tuple(
-                    jax_index_select(past_state, beam_idx, 0)
-                    for past_state in layer_past)
-                for layer_past in past)
+            return jax_index_select_tree(past, beam_idx)
 
         # Alpa
         mesh_groups = defaultdict(list)
@@ -153,7 +438,7 @@ class WrappedInferenceFunc(GenerationMixin):
                     mesh = past_state.device_mesh
                     mesh_groups[mesh].append(past_state)
 
-        beam_idx = beam_idx.to("cpu").numpy()
+        beam_idx = self._copy_beam_idx_to_host(beam_idx)
 
         def grouped_reorder_cache(arys, device_mesh):
             if len(arys) == 0:
@@ -168,7 +453,8 @@ class WrappedInferenceFunc(GenerationMixin):
                     avals, specs, beam_idx, dim, device_mesh,
                     [False] * len(avals))
                 self.index_select_executables[device_mesh] = executable
-            ret = executable(*arys, beam_idx)
+            sharded_beam_idx = self._shard_beam_idx(beam_idx, device_mesh)
+            ret = executable(*arys, sharded_beam_idx)
             for v in ret:
                 v.skip_shard_args_check = True
             return ret
@@ -183,16 +469,49 @@ class WrappedInferenceFunc(GenerationMixin):
                   for mesh, loc in layer_loc)
             for layer_loc in self.cache_location)
 
+    def _copy_beam_idx_to_host(self, beam_idx):
+        """Copy beam_idx into a reused int32 host buffer."""
+        if (self.beam_idx_buffer is None or
+                self.beam_idx_buffer.shape != beam_idx.shape):
+            self.beam_idx_buffer = torch.empty(
+                beam_idx.shape,
+                dtype=torch.int32,
+                pin_memory=torch.cuda.is_available())
+        self.beam_idx_buffer.copy_(beam_idx)
+        return self.beam_idx_buffer.numpy()
+
+    def _shard_beam_idx(self, beam_idx, device_mesh):
+        """Replicate beam_idx on a mesh, reusing the sharding of last steps."""
+        if device_mesh not in self.beam_idx_shardings:
+            aval = ShapedArray(beam_idx.shape, beam_idx.dtype)
+            spec = ShardingSpec((NoSharding(),),
+                                (Replicated(device_mesh.num_devices),))
+            indices = pxla.spec_to_indices(beam_idx.shape, spec)
+            self.beam_idx_shardings[device_mesh] = (aval, spec, indices)
+        aval, spec, indices = self.beam_idx_shardings[device_mesh]
+        return device_mesh.shard_args_to_arrays([aval], [indices], [spec],
+                                                [beam_idx])[0]
+
 
 def get_hf_gpt_model(model_name, device, num_beams):
     raw_model = GPT2LMHeadModel.from_pretrained(model_name)
     raw_model = raw_model.to(device)
+    raw_model.config.use_cache = True
 
     def inference_func(input_ids,
                        past_key_values,
+                       attention_mask=None,
                        output_attentions=False,
                        output_hidden_states=False):
+        position_ids = None
+        if attention_mask is not None:
+            # Skip the left padding tokens when counting positions
+            position_ids = attention_mask.long().cumsum(-1) - 1
+            position_ids.masked_fill_(attention_mask == 0, 1)
+            position_ids = position_ids[:, -input_ids.shape[1]:]
         out = raw_model(input_ids=input_ids,
+                        attention_mask=attention_mask,
+                        position_ids=position_ids,
                         past_key_values=past_key_values,
                         output_attentions=output_attentions,
                         output_hidden_states=output_hidden_states)
@@ -216,17 +535,27 @@ def get_hf_opt_model(model_name, device, num_beams):
         model_name,
         torch_dtype=torch.float16 if "cuda" in device else torch.float32)
     raw_model = raw_model.to(device)
+    raw_model.config.use_cache = True
+    # Allocate the all-ones attention mask once and pass views of it
+    attention_mask_buffer = None
 
     def inference_func(input_ids,
                        past_key_values,
+                       attention_mask=None,
                        output_attentions=False,
                        output_hidden_states=False):
-        if past_key_values is None:
-            attention_mask = None
-        else:
+        nonlocal attention_mask_buffer
+
+        if attention_mask is None and past_key_values is not None:
             past_length = past_key_values[0][0].shape[2]
-            attention_mask = torch.ones(
-                (input_ids.shape[0], past_length + 1)).to(device)
+            if (attention_mask_buffer is None or
+                    attention_mask_buffer.shape[0] != input_ids.shape[0]):
+                attention_mask_buffer = torch.ones(
+                    (input_ids.shape[0],
+                     raw_model.config.max_position_embeddings),
+                    device=device)
+            attention_mask = attention_mask_buffer[:, :past_length +
+                                                   input_ids.shape[1]]
         out = raw_model(input_ids=input_ids,
                         attention_mask=attention_mask,
                         past_key_values=past_key_values,
@@ -253,6 +582,8 @@ def get_model(model_name: str,
               path: str,
               autoregressive=True,
               dtype=jnp.float16,
+              cache_dtype=None,
+              weight_dtype=None,
               dummy=False,
               do_sample=False,
               batch_size=1,
@@ -269,6 +600,11 @@ def get_model(model_name: str,
         device: "cpu" or "gpu". This only controls the device used
           by pytorch. Alpa always runs on GPU.
         path: The path to opt weights.
+        cache_dtype: The dtype of the attention cache of jax/alpa models.
+          None means using dtype. jnp.int8 quantizes the cache.
+        weight_dtype: The dtype of the kernels of the linear layers of
+          jax/alpa models. None means using dtype. jnp.int8 quantizes the
+          kernels with a scale per output channel.
     """
     if not model_name.startswith("alpa") and not autoregressive:
         raise NotImplementedError(
@@ -279,6 +615,10 @@ def get_model(model_name: str,
     if autoregressive and num_micro_batches > 1:
         raise NotImplementedError(
             f"Cannot support num_micro_batches > 1 in autoregressive mode.")
+    if ((cache_dtype is not None or weight_dtype is not None) and
+            "jax/opt" not in model_name and "alpa/opt" not in model_name):
+        raise NotImplementedError(
+            f"Cannot support cache_dtype or weight_dtype for {model_name}.")
 
     if "gpt" in model_name:
         return get_hf_gpt_model(model_name, device, num_beams)
@@ -302,11 +642,20 @@ def get_model(model_name: str,
                 "`num_return_sequences` has to be smaller or equal to `num_beams`.")
         expand_size = batch_size * num_beams
 
+    # jax.jit compiles the step again for every new prompt length. Pad the
+    # prompts on the left to a multiple of prefill_bucket_size, so that
+    # prompts of similar lengths share one executable. The extra padding is
+    # masked out like the padding from the tokenizer. The cache gets extra
+    # slots for it, so the longest sequences still fit.
+    prefill_bucket_size = 64 if "jax/opt" in model_name else 1
+
     if "jax/opt" in model_name:
         config = get_opt_config(name,
                                 num_pp_stages=None,
                                 mark_boundary=False,
-                                dtype=dtype)
+                                dtype=dtype,
+                                cache_dtype=cache_dtype,
+                                weight_dtype=weight_dtype)
         transformer_config = TransformerModelConfig(
             H=config.decoder_embed_dim,
             L=config.decoder_layers,
@@ -321,7 +670,10 @@ def get_model(model_name: str,
 
         # load params
         params = load_params_np(params_aval, path, config, dummy)
-        init_cache = init_cache_np(config, batch_size=expand_size)
+        init_cache = init_cache_np(config,
+                                   batch_size=expand_size,
+                                   cache_len=config.max_target_positions +
+                                   prefill_bucket_size - 1)
         params, init_cache = jax.tree_map(jnp.array, (params, init_cache))
     else:
         assert "alpa/opt" in model_name
@@ -336,7 +688,11 @@ def get_model(model_name: str,
         num_pp_stages = max(2, alpa.get_global_cluster().num_hosts)
         num_pp_stages = min(num_pp_stages,
                             alpa.get_global_cluster().num_devices)
-        config = get_opt_config(name, num_pp_stages=num_pp_stages, dtype=dtype)
+        config = get_opt_config(name,
+                                num_pp_stages=num_pp_stages,
+                                dtype=dtype,
+                                cache_dtype=cache_dtype,
+                                weight_dtype=weight_dtype)
         transformer_config = TransformerModelConfig(
             H=config.decoder_embed_dim,
             L=config.decoder_layers,
@@ -344,8 +700,6 @@ def get_model(model_name: str,
             seq_len=config.max_target_positions,
             vocab_size=config.vocab_size)
 
-        if autoregressive:
-            assert batch_size == 1, "we only support batch_sie = 1 for autoregressive!"
         executable, params_aval = get_pipeshard_executable(
             config,
             batch_size=expand_size,
@@ -364,45 +718,156 @@ def get_model(model_name: str,
                                               expand_size,
                                               dummy=dummy)
             set_skip_shard_args_check(init_cache)
+        # load_params_dis_array only launches the loading on workers,
+        # so wait for the weights to be ready.
         executable.sync()
 
         # return executable directly if not autoregressive
         if not autoregressive:
             return executable, params, transformer_config
 
-    step_ct = 0
+    # The jax.jit executable runs on the same GPU as pytorch, so tensors can
+    # be exchanged through DLPack without going through the host.
+    # The alpa outputs live on remote workers and have to be fetched.
+    use_dlpack = "jax/opt" in model_name and "cuda" in device
+    # The alpa executable is compiled for inputs with length 1, while
+    # jax.jit can handle the whole prompt at once. The alpa steps cannot be
+    # folded into a lax.scan either, because the pipeline stage boundaries
+    # marked inside the model cannot be placed in a scan body.
+    max_step_len = 1 if "alpa/opt" in model_name else None
+    # Otherwise, stage the host copies of CUDA tensors in pinned memory,
+    # so that the copies use DMA directly and logits can be sent async.
+    use_pinned = "cuda" in device and not use_dlpack
+    staging_buffers = {}
+    logits_copy_done = None
+    # The number of left padding tokens of each row. It is computed once
+    # from the attention mask of the prompt and reused by the decoding
+    # steps. Beam search only reorders the beams of the same prompt, and
+    # they have the same padding, so the rows never need to be reordered.
+    left_pad_lens = None
+
+    def get_staging_buffer(name, shape, dtype):
+        buf = staging_buffers.get(name)
+        if buf is None or buf.shape != shape or buf.dtype != dtype:
+            buf = torch.empty(shape, dtype=dtype, pin_memory=True)
+            staging_buffers[name] = buf
+        return buf
 
     def inference_func(input_ids,
                        past_key_values,
+                       attention_mask=None,
                        output_attentions=False,
                        output_hidden_states=False):
-        nonlocal step_ct
+        nonlocal logits_copy_done, left_pad_lens
 
+        num_bucket_pads = 0
         if past_key_values is None:
             past_key_values = init_cache
-            step_ct = 0
-
-        input_ids_step = input_ids.cpu().numpy()
-        position_ids_step = np.full_like(input_ids_step,
-                                         step_ct + config.pad + 1)
-
-        output = executable(
-            params, {
-                "input_ids": input_ids_step,
-                "position_ids": position_ids_step,
-                "cache": past_key_values,
-            })
-        set_skip_shard_args_check(output.attention_cache)
-
-        logits_step = torch.from_numpy(np.array(output.logits)).to(device)
+            # Prompts are left padded, so the number of zeros in the
+            # attention mask is the number of padding tokens of each row.
+            if attention_mask is None:
+                left_pad_lens = np.zeros((input_ids.shape[0],), dtype=np.int32)
+            else:
+                check_left_padding(attention_mask)
+                left_pad_lens = (attention_mask == 0).sum(
+                    1, dtype=torch.int32).cpu().numpy()
+            num_bucket_pads = -input_ids.shape[1] % prefill_bucket_size
+            if num_bucket_pads:
+                input_ids = torch.nn.functional.pad(input_ids,
+                                                    (num_bucket_pads, 0),
+                                                    value=config.pad)
+                left_pad_lens = left_pad_lens + num_bucket_pads
+            # Keep it on the devices, so that the decoding steps do not
+            # send it again
+            if max_step_len is None:
+                left_pad_lens = jnp.asarray(left_pad_lens)
+            else:
+                left_pad_lens = init_left_pad_lens_dis_array(
+                    executable, left_pad_lens)
+
+        if use_dlpack:
+            # Make sure pending pytorch kernels that produce input_ids
+            # finish before jax reads the buffer.
+            input_ids = input_ids.to(torch.int32)
+            torch.cuda.current_stream().synchronize()
+            input_ids_step = jax.dlpack.from_dlpack(
+                torch.utils.dlpack.to_dlpack(input_ids))
+        else:
+            # Cast to int32 before the copy to halve the transferred bytes
+            # and skip the cast inside the executable.
+            input_ids = input_ids.to(torch.int32)
+            if use_pinned:
+                stage_in = get_staging_buffer("input_ids", input_ids.shape,
+                                              input_ids.dtype)
+                stage_in.copy_(input_ids)
+                input_ids_step = stage_in.numpy()
+            else:
+                input_ids_step = input_ids.cpu().numpy()
+        # Launch one step per input chunk. The launches are asynchronous,
+        # so the input of the next step is sent while the current step
+        # runs. Only the logits of the last step are fetched.
+        # Position ids are computed inside the executable from the cache.
+        input_len = input_ids_step.shape[1]
+        step_len = max_step_len or input_len
+        for start in range(0, input_len, step_len):
+            output = executable(
+                params, {
+                    "input_ids": input_ids_step[:, start:start + step_len],
+                    "cache": past_key_values,
+                    "left_pad_lens": left_pad_lens,
+                })
+            set_skip_shard_args_check(output.attention_cache)
+            past_key_values = output.attention_cache
+
+        logits = output.logits
+        if num_bucket_pads:
+            logits = logits[:, num_bucket_pads:]
+        if use_dlpack:
+            # Hand the buffer over to pytorch, since huggingface's logits
+            # processors modify the logits in place. The jax array is not
+            # used after this.
+            logits_step = torch.utils.dlpack.from_dlpack(
+                jax.dlpack.to_dlpack(logits, take_ownership=True))
+        elif use_pinned:
+            logits_np = torch.from_numpy(np.asarray(logits))
+            # Do not overwrite the buffer while the last copy is reading it
+            if logits_copy_done is not None:
+                logits_copy_done.synchronize()
+            stage_out = get_staging_buffer("logits", logits_np.shape,
+                                           logits_np.dtype)
+            stage_out.copy_(logits_np)
+            logits_step = stage_out.to(device, non_blocking=True)
+            logits_copy_done = torch.cuda.Event()
+            logits_copy_done.record()
+        else:
+            # np.asarray returns jax's read-only host buffer. Copy it, since
+            # huggingface's logits processors modify the logits in place.
+            logits_step = torch.from_numpy(np.array(logits)).to(device)
 
-        step_ct += 1
         return InferenceFuncOutput(logits_step, output.attention_cache,
                                    output.hidden_states, output.attentions)
 
     inference_func_config = InferenceFuncConfig(num_beams=num_beams)
-    return WrappedInferenceFunc(inference_func, inference_func_config,
-                                executable, transformer_config)
+    # The attention mask is only used to compute left_pad_lens at prefill
+    return WrappedInferenceFunc(inference_func,
+                                inference_func_config,
+                                executable,
+                                transformer_config,
+                                attention_mask_after_prefill=False)
+
+
+def check_left_padding(attention_mask):
+    """Check that the masked out tokens of each row are all at its start.
+
+    The jax/alpa models only support left padding. Right padding or pad
+    tokens inside a prompt would silently mask out prompt tokens.
+    """
+    if not (bool(attention_mask[:, -1].all()) and
+            bool((attention_mask[:, 1:] >= attention_mask[:, :-1]).all())):
+        raise ValueError(
+            "The attention mask must only mask out left padding tokens. "
+            "Pad the prompts on the left, and do not use pad_token_id "
+            "inside a prompt.")
 
 
 def set_skip_shard_args_check(attention_cache):